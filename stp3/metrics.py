@@ -1,10 +1,8 @@
 from typing import Optional
 
 import torch
-import torch.nn as nn
 import numpy as np
 from pytorch_lightning.metrics.metric import Metric
-from pytorch_lightning.metrics.functional.classification import stat_scores_multiple_classes
 from pytorch_lightning.metrics.functional.reduction import reduce
 from skimage.draw import polygon
 
@@ -12,6 +10,38 @@ from stp3.utils.tools import gen_dx_bx
 from stp3.utils.geometry import calculate_birds_eye_view_parameters
 
 
+# Number of bins from which _bincount uses index_add_ on CUDA. Below it torch.bincount keeps its histogram in
+# shared memory and is fast, and index_add_ would suffer from atomic contention on the few bins.
+_BINCOUNT_INDEX_ADD_MIN_BINS = 10000
+
+
+def _bincount(x: torch.Tensor, minlength: int) -> torch.Tensor:
+    """Same as torch.bincount for 1d inputs whose values all lie in [0, minlength).
+
+    torch.bincount is very slow on GPU when minlength is large, so in that case the counts are accumulated into
+    a preallocated tensor with index_add_ instead.
+    """
+    x = x.long()
+    if x.is_cuda and minlength >= _BINCOUNT_INDEX_ADD_MIN_BINS:
+        counts = torch.zeros(minlength, dtype=torch.long, device=x.device)
+        return counts.index_add_(0, x, torch.ones_like(x))
+    return torch.bincount(x, minlength=minlength)
+
+
+def _rasterize_footprint(H: float, W: float, dx: np.ndarray, bx: np.ndarray) -> np.ndarray:
+    """Returns the (row, col) bev pixels covered by an ego box of length H and width W centred on the origin."""
+    pts = np.array([
+        [-H / 2. + 0.5, W / 2.],
+        [H / 2. + 0.5, W / 2.],
+        [H / 2. + 0.5, -W / 2.],
+        [-H / 2. + 0.5, -W / 2.],
+    ])
+    pts = (pts - bx) / dx
+    pts[:, [0, 1]] = pts[:, [1, 0]]
+    rr, cc = polygon(pts[:,1], pts[:,0])
+    return np.concatenate([rr[:,None], cc[:,None]], axis=-1)
+
+
 class IntersectionOverUnion(Metric):
     """Computes intersection-over-union."""
     def __init__(
@@ -35,7 +65,18 @@ class IntersectionOverUnion(Metric):
         self.add_state('support', default=torch.zeros(n_classes), dist_reduce_fx='sum')
 
     def update(self, prediction: torch.Tensor, target: torch.Tensor):
-        tps, fps, _, fns, sups = stat_scores_multiple_classes(prediction, target, self.n_classes)
+        # Confusion matrix with targets as rows and predictions as columns. As in stat_scores_multiple_classes,
+        # labels >= n_classes are gathered into an extra bin that is left out of the statistics.
+        n_bins = self.n_classes + 1
+        prediction = prediction.long().clamp_max(self.n_classes).reshape(-1)
+        target = target.long().clamp_max(self.n_classes).reshape(-1)
+        # Only (n_classes + 1)^2 bins, a case where torch.bincount is fast.
+        confusion_matrix = torch.bincount(target * n_bins + prediction, minlength=n_bins ** 2).view(n_bins, n_bins)
+
+        tps = confusion_matrix.diag()[:self.n_classes]
+        fps = confusion_matrix.sum(0)[:self.n_classes] - tps
+        fns = confusion_matrix.sum(1)[:self.n_classes] - tps
+        sups = confusion_matrix.sum(1)[:self.n_classes]
 
         self.true_positive += tps
         self.false_positive += fps
@@ -43,30 +84,24 @@ class IntersectionOverUnion(Metric):
         self.support += sups
 
     def compute(self):
-        scores = torch.zeros(self.n_classes, device=self.true_positive.device, dtype=torch.float32)
-
-        for class_idx in range(self.n_classes):
-            if class_idx == self.ignore_index:
-                continue
-
-            tp = self.true_positive[class_idx]
-            fp = self.false_positive[class_idx]
-            fn = self.false_negative[class_idx]
-            sup = self.support[class_idx]
-
-            # If this class is absent in the target (no support) AND absent in the pred (no true or false
-            # positives), then use the absent_score for this class.
-            if sup + tp + fp == 0:
-                scores[class_idx] = self.absent_score
-                continue
-
-            denominator = tp + fp + fn
-            score = tp.to(torch.float) / denominator
-            scores[class_idx] = score
+        tp = self.true_positive
+        fp = self.false_positive
+        fn = self.false_negative
+        sup = self.support
+
+        # If a class is absent in the target (no support) AND absent in the pred (no true or false
+        # positives), then use the absent_score for this class.
+        absent = (sup + tp + fp) == 0
+        denominator = (tp + fp + fn).to(torch.float)
+        scores = torch.where(
+            absent,
+            torch.full_like(denominator, self.absent_score),
+            tp.to(torch.float) / denominator.clamp_min(1.0),
+        )
 
-        # Remove the ignored class index from the scores.
-        if (self.ignore_index is not None) and (0 <= self.ignore_index < self.n_classes):
-            scores = torch.cat([scores[:self.ignore_index], scores[self.ignore_index+1:]])
+        # Remove the ignored class index from the scores. Indices outside of [0, n_classes) match no class.
+        if self.ignore_index is not None:
+            scores = scores[torch.arange(self.n_classes, device=scores.device) != self.ignore_index]
 
         return reduce(scores, reduction=self.reduction)
 
@@ -102,36 +137,26 @@ class PanopticMetric(Metric):
             gt_instance: (b, s, h, w)
                 Ground truth instance segmentation.
         """
-        batch_size, sequence_length = gt_instance.shape[:2]
         # Process labels
         assert gt_instance.min() == 0, 'ID 0 of gt_instance must be background'
+        pred_instance = pred_instance.detach()
         pred_segmentation = (pred_instance > 0).long()
         gt_segmentation = (gt_instance > 0).long()
+        n_instances = int(torch.stack([pred_instance.max(), gt_instance.max()]).max().item())
 
-        for b in range(batch_size):
-            unique_id_mapping = {}
-            for t in range(sequence_length):
-                result = self.panoptic_metrics(
-                    pred_segmentation[b, t].detach(),
-                    pred_instance[b, t].detach(),
-                    gt_segmentation[b, t],
-                    gt_instance[b, t],
-                    unique_id_mapping,
-                )
-
-                self.iou += result['iou']
-                self.true_positive += result['true_positive']
-                self.false_positive += result['false_positive']
-                self.false_negative += result['false_negative']
+        result = self.panoptic_metrics(pred_segmentation, pred_instance, gt_segmentation, gt_instance, n_instances)
+
+        self.iou += result['iou']
+        self.true_positive += result['true_positive']
+        self.false_positive += result['false_positive']
+        self.false_negative += result['false_negative']
 
     def compute(self):
-        denominator = torch.maximum(
-            (self.true_positive + self.false_positive / 2 + self.false_negative / 2),
-            torch.ones_like(self.true_positive)
-        )
+        tp = self.true_positive
+        denominator = (tp + self.false_positive / 2 + self.false_negative / 2).clamp_min(1.0)
         pq = self.iou / denominator
-        sq = self.iou / torch.maximum(self.true_positive, torch.ones_like(self.true_positive))
-        rq = self.true_positive / denominator
+        sq = self.iou / tp.clamp_min(1.0)
+        rq = tp / denominator
 
         return {'pq': pq,
                 'sq': sq,
@@ -140,125 +165,184 @@ class PanopticMetric(Metric):
                 # 'denominator': (self.true_positive + self.false_positive / 2 + self.false_negative / 2),
                 }
 
-    def panoptic_metrics(self, pred_segmentation, pred_instance, gt_segmentation, gt_instance, unique_id_mapping):
+    def panoptic_metrics(self, pred_segmentation, pred_instance, gt_segmentation, gt_instance, n_instances):
         """
-        Computes panoptic quality metric components.
+        Computes panoptic quality metric components over a batch of sequences.
+
+        All frames are processed at once: the confusion matrices of every frame are computed with a single
+        bincount, and temporal consistency of the instance ids is checked along the sequence dimension.
 
         Parameters
         ----------
-            pred_segmentation: [H, W] range {0, ..., n_classes-1} (>= n_classes is void)
-            pred_instance: [H, W] range {0, ..., n_instances} (zero means background)
-            gt_segmentation: [H, W] range {0, ..., n_classes-1} (>= n_classes is void)
-            gt_instance: [H, W] range {0, ..., n_instances} (zero means background)
-            unique_id_mapping: instance id mapping to check consistency
+            pred_segmentation: [B, S, H, W] range {0, ..., n_classes-1} (>= n_classes is void)
+            pred_instance: [B, S, H, W] range {0, ..., n_instances} (zero means background)
+            gt_segmentation: [B, S, H, W] range {0, ..., n_classes-1} (>= n_classes is void)
+            gt_instance: [B, S, H, W] range {0, ..., n_instances} (zero means background)
+            n_instances: largest instance id of pred_instance and gt_instance
         """
         n_classes = self.n_classes
+        device = gt_instance.device
 
-        result = {key: torch.zeros(n_classes, dtype=torch.float32, device=gt_instance.device) for key in self.keys}
+        result = {key: torch.zeros(n_classes, dtype=torch.float32, device=device) for key in self.keys}
 
-        assert pred_segmentation.dim() == 2
+        assert pred_segmentation.dim() == 4
         assert pred_segmentation.shape == pred_instance.shape == gt_segmentation.shape == gt_instance.shape
 
-        n_instances = int(torch.cat([pred_instance, gt_instance]).max().item())
+        batch_size, sequence_length, height, width = gt_instance.shape
+        n_frames = batch_size * sequence_length
+
+        # Crop all frames to the bounding box of the pixels that are not background in any of the inputs.
+        # IoUs of things are unchanged, and the cropped out pixels are added back to the background
+        # intersection once the confusion matrix is computed.
+        foreground = (pred_instance > 0) | (gt_instance > 0) | (pred_segmentation != 0) | (gt_segmentation != 0)
+        ys, xs = foreground.view(n_frames, height, width).any(0).nonzero(as_tuple=True)
+        if ys.numel() == 0:
+            y0, y1, x0, x1 = 0, 0, 0, 0
+        else:
+            y0, y1, x0, x1 = torch.stack([ys.min(), ys.max(), xs.min(), xs.max()]).tolist()
+        pred_segmentation = pred_segmentation[..., y0:y1 + 1, x0:x1 + 1]
+        pred_instance = pred_instance[..., y0:y1 + 1, x0:x1 + 1]
+        gt_segmentation = gt_segmentation[..., y0:y1 + 1, x0:x1 + 1]
+        gt_instance = gt_instance[..., y0:y1 + 1, x0:x1 + 1]
+        n_cropped_background = height * width - (y1 + 1 - y0) * (x1 + 1 - x0)
+
         n_all_things = n_instances + n_classes  # Classes + instances.
         n_things_and_void = n_all_things + 1
 
-        # Now 1 is background; 0 is void (not used). 2 is vehicle semantic class but since it overlaps with
+        # Now 1 is background; 0 is void (not used). 2 is vehicle semantic class but since it overlaps with
         # instances, it is not present.
         # and the rest are instance ids starting from 3
         prediction, pred_to_cls = self.combine_mask(pred_segmentation, pred_instance, n_classes, n_all_things)
         target, target_to_cls = self.combine_mask(gt_segmentation, gt_instance, n_classes, n_all_things)
 
-        # Compute ious between all stuff and things
-        # hack for bincounting 2 arrays together
-        x = prediction + n_things_and_void * target
-        bincount_2d = torch.bincount(x.long(), minlength=n_things_and_void ** 2)
-        if bincount_2d.shape[0] != n_things_and_void ** 2:
-            raise ValueError('Incorrect bincount size.')
-        conf = bincount_2d.reshape((n_things_and_void, n_things_and_void))
-        # Drop void class
-        conf = conf[1:, 1:]
+        conf, iou = self._pq_core(prediction, target, n_things_and_void, n_cropped_background)
 
-        # Confusion matrix contains intersections between all combinations of classes
-        union = conf.sum(0).unsqueeze(0) + conf.sum(1).unsqueeze(1) - conf
-        iou = torch.where(union > 0, (conf.float() + 1e-9) / (union.float() + 1e-9), torch.zeros_like(union).float())
-
-        # In the iou matrix, first dimension is target idx, second dimension is pred idx.
-        # Mapping will contain a tuple that maps prediction idx to target idx for segments matched by iou.
+        # In the iou matrix, the last two dimensions are target idx and pred idx.
+        # Mapping will contain (batch idx, time idx, target idx, pred idx) for segments matched by iou.
         mapping = (iou > 0.5).nonzero(as_tuple=False)
 
         # Check that classes match.
-        is_matching = pred_to_cls[mapping[:, 1]] == target_to_cls[mapping[:, 0]]
+        b, t, target_id, pred_id = mapping.unbind(1)
+        is_matching = pred_to_cls[b, t, pred_id] == target_to_cls[b, t, target_id]
         mapping = mapping[is_matching]
+        b, t, target_id, pred_id = mapping.unbind(1)
         tp_mask = torch.zeros_like(conf, dtype=torch.bool)
-        tp_mask[mapping[:, 0], mapping[:, 1]] = True
+        tp_mask[b, t, target_id, pred_id] = True
 
         # First ids correspond to "stuff" i.e. semantic seg.
         # Instance ids are offset accordingly
-        for target_id, pred_id in mapping:
-            cls_id = pred_to_cls[pred_id]
-
-            if self.temporally_consistent and cls_id == self.vehicles_id:
-                if target_id.item() in unique_id_mapping and unique_id_mapping[target_id.item()] != pred_id.item():
-                    # Not temporally consistent
-                    result['false_negative'][target_to_cls[target_id]] += 1
-                    result['false_positive'][pred_to_cls[pred_id]] += 1
-                    unique_id_mapping[target_id.item()] = pred_id.item()
-                    continue
-
-            result['true_positive'][cls_id] += 1
-            result['iou'][cls_id] += iou[target_id][pred_id]
-            unique_id_mapping[target_id.item()] = pred_id.item()
-
-        for target_id in range(n_classes, n_all_things):
-            # If this is a true positive do nothing.
-            if tp_mask[target_id, n_classes:].any():
-                continue
-            # If this target instance didn't match with any predictions and was present set it as false negative.
-            if target_to_cls[target_id] != -1:
-                result['false_negative'][target_to_cls[target_id]] += 1
-
-        for pred_id in range(n_classes, n_all_things):
-            # If this is a true positive do nothing.
-            if tp_mask[n_classes:, pred_id].any():
-                continue
-            # If this predicted instance didn't match with any prediction, set that predictions as false positive.
-            if pred_to_cls[pred_id] != -1 and (conf[:, pred_id] > 0).any():
-                result['false_positive'][pred_to_cls[pred_id]] += 1
+        cls_id = pred_to_cls[b, t, pred_id]
+        is_consistent = torch.ones_like(cls_id, dtype=torch.bool)
+        if self.temporally_consistent:
+            # Prediction id matched to each target id in every frame, -1 if the target was not matched.
+            matched_pred_id = torch.full(conf.shape[:3], -1, dtype=torch.long, device=device)
+            matched_pred_id[b, t, target_id] = pred_id
+            # Last frame before the current one in which each target id was matched, -1 if there is none.
+            time_idx = torch.arange(sequence_length, device=device).view(1, sequence_length, 1)
+            last_matched_time = torch.where(matched_pred_id != -1, time_idx, -torch.ones_like(matched_pred_id))
+            last_matched_time = last_matched_time.cummax(dim=1).values
+            previous_time = torch.cat([-torch.ones_like(last_matched_time[:, :1]), last_matched_time[:, :-1]], dim=1)
+            previous_pred_id = torch.where(
+                previous_time != -1,
+                matched_pred_id.gather(1, previous_time.clamp_min(0)),
+                -torch.ones_like(previous_time),
+            )[b, t, target_id]
+            is_consistent = (cls_id != self.vehicles_id) | (previous_pred_id == -1) | (previous_pred_id == pred_id)
+
+        # Not temporally consistent
+        is_inconsistent = (~is_consistent).float()
+        result['false_negative'].scatter_add_(0, target_to_cls[b, t, target_id], is_inconsistent)
+        result['false_positive'].scatter_add_(0, cls_id, is_inconsistent)
+
+        is_consistent = is_consistent.float()
+        result['true_positive'].scatter_add_(0, cls_id, is_consistent)
+        result['iou'].scatter_add_(0, cls_id, iou[b, t, target_id, pred_id] * is_consistent)
+
+        # Unmatched ids (class -1) are masked out below, so they can be scattered into any class with a zero count.
+        things_tp_mask = tp_mask[..., n_classes:, n_classes:]
+
+        # If a target instance didn't match with any predictions and was present set it as false negative.
+        target_things_to_cls = target_to_cls[..., n_classes:]
+        is_false_negative = ~things_tp_mask.any(-1) & (target_things_to_cls != -1)
+        result['false_negative'].scatter_add_(
+            0, target_things_to_cls.clamp_min(0).view(-1), is_false_negative.view(-1).float()
+        )
+
+        # If a predicted instance didn't match with any target and was present set it as false positive.
+        pred_things_to_cls = pred_to_cls[..., n_classes:]
+        is_false_positive = ~things_tp_mask.any(-2) & (pred_things_to_cls != -1) \
+            & (conf[..., n_classes:] > 0).any(-2)
+        result['false_positive'].scatter_add_(
+            0, pred_things_to_cls.clamp_min(0).view(-1), is_false_positive.view(-1).float()
+        )
 
         return result
 
+    @staticmethod
+    def _pq_core(prediction, target, n_things_and_void: int, n_cropped_background: int):
+        """
+        Computes the confusion matrices and ious between all stuff and things of every frame.
+
+        Parameters
+        ----------
+            prediction: [B, S, N] combined prediction mask, range {0, ..., n_things_and_void-1} (0 is void)
+            target: [B, S, N] combined target mask, range {0, ..., n_things_and_void-1} (0 is void)
+            n_things_and_void: number of ids in the combined masks
+            n_cropped_background: number of background pixels of every frame that are not in the masks
+
+        Returns
+        -------
+            conf: [B, S, n_things_and_void-1, n_things_and_void-1] intersections between target and pred ids
+            iou: [B, S, n_things_and_void-1, n_things_and_void-1] ious between target and pred ids
+        """
+        batch_size, sequence_length = target.shape[:2]
+        n_frames = batch_size * sequence_length
+
+        # hack for bincounting 2 arrays together, every frame being offset to its own block of bins
+        frame_offset = torch.arange(n_frames, device=target.device).view(batch_size, sequence_length, 1)
+        x = prediction + n_things_and_void * target + frame_offset * n_things_and_void ** 2
+        bincount_2d = _bincount(x.view(-1), minlength=n_frames * n_things_and_void ** 2)
+        if bincount_2d.shape[0] != n_frames * n_things_and_void ** 2:
+            raise ValueError('Incorrect bincount size.')
+        conf = bincount_2d.reshape((batch_size, sequence_length, n_things_and_void, n_things_and_void))
+        # Background (id 1) in both prediction and target outside of the cropped area.
+        conf[..., 1, 1] += n_cropped_background
+        # Drop void class
+        conf = conf[..., 1:, 1:]
+
+        # Confusion matrix contains intersections between all combinations of classes
+        union = conf.sum(-2, keepdim=True) + conf.sum(-1, keepdim=True) - conf
+        iou = torch.where(union > 0, (conf.float() + 1e-9) / (union.float() + 1e-9), torch.zeros_like(union).float())
+
+        return conf, iou
+
     def combine_mask(self, segmentation: torch.Tensor, instance: torch.Tensor, n_classes: int, n_all_things: int):
         """Shifts all things ids by num_classes and combines things and stuff into a single mask
 
-        Returns a combined mask + a mapping from id to segmentation class.
+        Inputs are [..., H, W] and every leading index is treated as a separate frame.
+        Returns a combined mask [..., H*W] + a mapping from id to segmentation class [..., n_all_things].
         """
-        instance = instance.view(-1)
+        frames_shape = instance.shape[:-2]
+        instance = instance.reshape(-1, instance.shape[-2] * instance.shape[-1])
         instance_mask = instance > 0
         instance = instance - 1 + n_classes
 
-        segmentation = segmentation.clone().view(-1)
+        segmentation = segmentation.reshape(instance.shape)
         segmentation_mask = segmentation < n_classes  # Remove void pixels.
 
-        # Build an index from instance id to class id.
-        instance_id_to_class_tuples = torch.cat(
-            (
-                instance[instance_mask & segmentation_mask].unsqueeze(1),
-                segmentation[instance_mask & segmentation_mask].unsqueeze(1),
-            ),
-            dim=1,
-        )
-        instance_id_to_class = -instance_id_to_class_tuples.new_ones((n_all_things,))
-        instance_id_to_class[instance_id_to_class_tuples[:, 0]] = instance_id_to_class_tuples[:, 1]
-        instance_id_to_class[torch.arange(n_classes, device=segmentation.device)] = torch.arange(
-            n_classes, device=segmentation.device
-        )
+        # Build an index from (frame, instance id) to class id. Pixels that are not both instance and
+        # non-void are scattered into an extra sentinel id, which is dropped afterwards.
+        index = torch.where(instance_mask & segmentation_mask, instance, torch.full_like(instance, n_all_things))
+        instance_id_to_class = -segmentation.new_ones((instance.shape[0], n_all_things + 1))
+        instance_id_to_class.scatter_(1, index, segmentation)
+        class_ids = torch.arange(n_all_things, device=segmentation.device)
+        instance_id_to_class = torch.where(class_ids < n_classes, class_ids, instance_id_to_class[:, :n_all_things])
 
-        segmentation[instance_mask] = instance[instance_mask]
-        segmentation += 1  # Shift all legit classes by 1.
-        segmentation[~segmentation_mask] = 0  # Shift void class to zero.
+        segmentation = torch.where(instance_mask, instance, segmentation)
+        # Shift all legit classes by 1 and void class to zero.
+        segmentation = torch.where(segmentation_mask, segmentation + 1, torch.zeros_like(segmentation))
 
-        return segmentation, instance_id_to_class
+        return segmentation.view(*frames_shape, -1), instance_id_to_class.view(*frames_shape, n_all_things)
 
 class PlanningMetric(Metric):
     def __init__(
@@ -270,17 +354,21 @@ class PlanningMetric(Metric):
         super().__init__(compute_on_step=compute_on_step)
         dx, bx, _ = gen_dx_bx(cfg.LIFT.X_BOUND, cfg.LIFT.Y_BOUND, cfg.LIFT.Z_BOUND)
         dx, bx = dx[:2], bx[:2]
-        self.dx = nn.Parameter(dx, requires_grad=False)
-        self.bx = nn.Parameter(bx, requires_grad=False)
+        self.register_buffer('dx', dx)
+        self.register_buffer('bx', bx)
 
-        _, _, self.bev_dimension = calculate_birds_eye_view_parameters(
+        _, _, bev_dimension = calculate_birds_eye_view_parameters(
             cfg.LIFT.X_BOUND, cfg.LIFT.Y_BOUND, cfg.LIFT.Z_BOUND
         )
-        self.bev_dimension = self.bev_dimension.numpy()
+        self._bev_rows, self._bev_cols = int(bev_dimension[0]), int(bev_dimension[1])
 
         self.W = cfg.EGO.WIDTH
         self.H = cfg.EGO.HEIGHT
 
+        rc = _rasterize_footprint(self.H, self.W, dx.numpy(), bx.numpy())
+        self.register_buffer('footprint_rc', torch.from_numpy(rc).long(), persistent=False)
+        self.register_buffer('_flip_xy', torch.tensor([-1.0, 1.0]), persistent=False)
+
         self.n_future = n_future
 
         self.add_state("obj_col", default=torch.zeros(self.n_future), dist_reduce_fx="sum")
@@ -289,46 +377,25 @@ class PlanningMetric(Metric):
         self.add_state("total", default=torch.tensor(0), dist_reduce_fx="sum")
 
 
-    def evaluate_single_coll(self, traj, segmentation):
+    def _coll_batch(self, traj_stack, segmentation):
         '''
-        gt_segmentation
-        traj: torch.Tensor (n_future, 2)
-        segmentation: torch.Tensor (n_future, 200, 200)
+        traj_stack: torch.Tensor (N, B, n_future, 2)
+        segmentation: torch.Tensor (B, n_future, 200, 200)
+        returns: torch.Tensor (N, B, n_future) box collision of each trajectory
         '''
-        pts = np.array([
-            [-self.H / 2. + 0.5, self.W / 2.],
-            [self.H / 2. + 0.5, self.W / 2.],
-            [self.H / 2. + 0.5, -self.W / 2.],
-            [-self.H / 2. + 0.5, -self.W / 2.],
-        ])
-        pts = (pts - self.bx.cpu().numpy()) / (self.dx.cpu().numpy())
-        pts[:, [0, 1]] = pts[:, [1, 0]]
-        rr, cc = polygon(pts[:,1], pts[:,0])
-        rc = np.concatenate([rr[:,None], cc[:,None]], axis=-1)
-
-        n_future, _ = traj.shape
-        trajs = traj.view(n_future, 1, 2)
-        trajs[:,:,[0,1]] = trajs[:,:,[1,0]] # can also change original tensor
-        trajs = trajs / self.dx
-        trajs = trajs.cpu().numpy() + rc # (n_future, 32, 2)
-
-        r = trajs[:,:,0].astype(np.int32)
-        r = np.clip(r, 0, self.bev_dimension[0] - 1)
-
-        c = trajs[:,:,1].astype(np.int32)
-        c = np.clip(c, 0, self.bev_dimension[1] - 1)
-
-        collision = np.full(n_future, False)
-        for t in range(n_future):
-            rr = r[t]
-            cc = c[t]
-            I = np.logical_and(
-                np.logical_and(rr >= 0, rr < self.bev_dimension[0]),
-                np.logical_and(cc >= 0, cc < self.bev_dimension[1]),
-            )
-            collision[t] = np.any(segmentation[t, rr[I], cc[I]].cpu().numpy())
-
-        return torch.from_numpy(collision).to(device=traj.device)
+        n_trajs, B, n_future, _ = traj_stack.shape
+        trajs = traj_stack[..., [1, 0]] / self.dx
+        trajs = trajs.view(n_trajs, B, n_future, 1, 2) + self.footprint_rc # (N, B, n_future, 32, 2)
+
+        rc = trajs.long()
+        r = torch.clamp(rc[..., 0], 0, self._bev_rows - 1)
+        c = torch.clamp(rc[..., 1], 0, self._bev_cols - 1)
+
+        bi = torch.arange(B, device=segmentation.device).view(1, B, 1, 1)
+        ti = torch.arange(n_future, device=segmentation.device).view(1, 1, n_future, 1)
+        collision = segmentation[bi, ti, r, c].any(dim=-1)
+
+        return collision
 
     def evaluate_coll(self, trajs, gt_trajs, segmentation):
         '''
@@ -337,31 +404,30 @@ class PlanningMetric(Metric):
         segmentation: torch.Tensor (B, n_future, 200, 200)
         '''
         B, n_future, _ = trajs.shape
-        trajs = trajs * torch.tensor([-1, 1], device=trajs.device)
-        gt_trajs = gt_trajs * torch.tensor([-1, 1], device=gt_trajs.device)
+        flip_xy = self._flip_xy.to(trajs.dtype)
+        trajs = trajs * flip_xy
+        gt_trajs = gt_trajs * flip_xy
 
-        obj_coll_sum = torch.zeros(n_future, device=segmentation.device)
-        obj_box_coll_sum = torch.zeros(n_future, device=segmentation.device)
+        gt_box_coll, box_coll = self._coll_batch(torch.stack([gt_trajs, trajs]), segmentation)
 
-        for i in range(B):
-            gt_box_coll = self.evaluate_single_coll(gt_trajs[i], segmentation[i])
+        yx = ((trajs[:, :, [1, 0]] - self.bx) / self.dx).long()
+        yi, xi = yx[..., 0], yx[..., 1]
 
-            xx, yy = trajs[i,:,0], trajs[i, :, 1]
-            yi = ((yy - self.bx[0]) / self.dx[0]).long()
-            xi = ((xx - self.bx[1]) / self.dx[1]).long()
-
-            m1 = torch.logical_and(
-                torch.logical_and(yi >= 0, yi < self.bev_dimension[0]),
-                torch.logical_and(xi >= 0, xi < self.bev_dimension[1]),
-            )
-            m1 = torch.logical_and(m1, torch.logical_not(gt_box_coll))
+        m1 = torch.logical_and(
+            torch.logical_and(yi >= 0, yi < self._bev_rows),
+            torch.logical_and(xi >= 0, xi < self._bev_cols),
+        )
+        m1 = torch.logical_and(m1, torch.logical_not(gt_box_coll))
 
-            ti = torch.arange(n_future)
-            obj_coll_sum[ti[m1]] += segmentation[i, ti[m1], yi[m1], xi[m1]].long()
+        # Out of bev positions are masked by m1, clamp them only to gather safely.
+        yi = torch.clamp(yi, 0, self._bev_rows - 1)
+        xi = torch.clamp(xi, 0, self._bev_cols - 1)
+        bi = torch.arange(B, device=segmentation.device).view(B, 1)
+        ti = torch.arange(n_future, device=segmentation.device).view(1, n_future)
+        obj_coll_sum = (segmentation[bi, ti, yi, xi].long() * m1).sum(dim=0).float()
 
-            m2 = torch.logical_not(gt_box_coll)
-            box_coll = self.evaluate_single_coll(trajs[i], segmentation[i])
-            obj_box_coll_sum[ti[m2]] += (box_coll[ti[m2]]).long()
+        m2 = torch.logical_not(gt_box_coll)
+        obj_box_coll_sum = (box_coll.long() * m2).sum(dim=0).float()
 
         return obj_coll_sum, obj_box_coll_sum
 
@@ -371,7 +437,7 @@ class PlanningMetric(Metric):
         gt_trajs: torch.Tensor (B, n_future, 3)
         '''
 
-        return torch.sqrt(((trajs[:, :, :2] - gt_trajs[:, :, :2]) ** 2).sum(dim=-1))
+        return torch.linalg.vector_norm(trajs[:, :, :2] - gt_trajs[:, :, :2], dim=-1)
 
     def update(self, trajs, gt_trajs, segmentation):
         '''